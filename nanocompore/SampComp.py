@@ -4,17 +4,26 @@
 # Std lib
 from loguru import logger
 from collections import *
-import shelve
-import multiprocessing as mp
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import faulthandler
 import traceback
 import json
 import datetime
 import os
+import io
+import mmap
+from functools import lru_cache
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
 
 # Third party
 import yaml
 from tqdm import tqdm
 import numpy as np
+import pandas as pd
 from pyfaidx import Fasta
 
 # Local package
@@ -107,7 +116,7 @@ class SampComp(object):
         * exclude_ref_id
             if given, refid in the list will be excluded from the analysis.
         * nthreads
-            Number of threads (two are used for reading and writing, all the others for parallel processing).
+            Number of threads (one is used to dispatch the references and write the results, all the others for parallel processing).
         * log_level
             Set the log level. {warning,info,debug}
         """
@@ -150,15 +159,22 @@ class SampComp(object):
         eventalign_fn_dict = self.__check_eventalign_fn_dict(eventalign_fn_dict)
         logger.debug(eventalign_fn_dict)
 
+        # Check the binary caches of the eventalign files if available
+        for sample_dict in eventalign_fn_dict.values():
+            for fn in sample_dict.values():
+                if _has_eventalign_cache(fn):
+                    logger.debug("Using binary cache for {}".format(fn))
+                    _open_eventalign_cache(fn)
+
         # Check if fasta and bed files exist
         if not access_file(fasta_fn):
             raise NanocomporeError("{} is not a valid FASTA file".format(fasta_fn))
         if bed_fn and not access_file(bed_fn):
             raise NanocomporeError("{} is not a valid BED file".format(bed_fn))
 
-        # Check at least 3 threads
-        if nthreads < 3:
-            raise NanocomporeError("The minimum number of threads is 3")
+        # Check at least 2 threads, one dispatching and writing and one worker
+        if nthreads < 2:
+            raise NanocomporeError("The minimum number of threads is 2")
 
         # Parse comparison methods
         if comparison_methods:
@@ -206,7 +222,7 @@ class SampComp(object):
         self.__allow_warnings = allow_warnings
         self.__sequence_context = sequence_context
         self.__sequence_context_weights = sequence_context_weights
-        self.__nthreads = nthreads - 2
+        self.__nthreads = nthreads - 1
         self.__log_level = log_level
 
         # Get number of samples
@@ -216,32 +232,82 @@ class SampComp(object):
                 n+=1
         self.__n_samples = n
 
+        # Compile the read accumulation kernel once before the workers are forked
+        if numba:
+            logger.debug("Compiling numba read accumulation kernel")
+            _warmup_accumulate_read()
+
     def __call__(self):
         """
         Run the analysis
         """
         logger.info("Starting data processing")
-        # Init Multiprocessing variables
-        in_q = mp.Queue(maxsize = 100)
-        out_q = mp.Queue(maxsize = 100)
-        error_q = mp.Queue()
-
-        # Define processes
-        ps_list = []
-        ps_list.append(mp.Process(target=self.__list_refid, args=(in_q, error_q)))
-        for i in range(self.__nthreads):
-            ps_list.append(mp.Process(target=self.__process_references, args=(in_q, out_q, error_q)))
-        ps_list.append(mp.Process(target=self.__write_output, args=(out_q, error_q)))
-
-        # Start processes and monitor error queue
+        # Start the shared memory resource tracker before forking so that all the processes register to the same one
+        if shared_memory:
+            resource_tracker.ensure_running()
+
+        # Options needed by the workers to process the references
+        worker_cfg = _WorkerCfg(
+            eventalign_fn_dict = self.__eventalign_fn_dict,
+            fasta_fn = self.__fasta_fn,
+            comparison_methods = self.__comparison_methods,
+            sequence_context = self.__sequence_context,
+            sequence_context_weights = self.__sequence_context_weights,
+            min_coverage = self.__min_coverage,
+            allow_warnings = self.__allow_warnings,
+            logit = self.__logit,
+            max_pending = self.__nthreads*4)
+
+        pvalue_tests = set()
+        ref_id_list = []
+        ref_offset_dict = OrderedDict()
+        # Refresh the progress bar at most every 200th of the references or every half second
+        pbar = tqdm(total = len(self.__whitelist), unit=" Processed References", disable=self.__log_level in ("warning", "debug"),
+            miniters=max(1, len(self.__whitelist)//200), mininterval=0.5)
         try:
-            # Start all processes
-            for ps in ps_list:
-                ps.start()
-            # Monitor error queue
-            for tb in iter(error_q.get, None):
-                logger.trace("Error caught from error_q")
-                raise NanocomporeError(tb)
+            # Large write buffer to batch the results of small references in fewer write calls
+            with open(self.__db_fn, "wb", buffering=4*1024*1024) as db_fp, _make_executor(self.__nthreads, worker_cfg) as executor:
+                # Dispatch the references to the workers and write the results in the database file as they complete
+                result_iter = imap_unordered_bounded(executor, _process_ref_task, self.__whitelist, max_pending=worker_cfg.max_pending, discard_fn=_discard_ref_result)
+                try:
+                    for ref_id, ref_pos_list, shm_name, layout in result_iter:
+                        ref_id_list.append(ref_id)
+                        logger.debug("Writing %s"%ref_id)
+                        # Get pvalue fields available in analysed data before
+                        for pos_dict in ref_pos_list:
+                            if 'txComp' in pos_dict:
+                                for res in pos_dict['txComp'].keys():
+                                    if "pvalue" in res:
+                                        pvalue_tests.add(res)
+                        # Append pickled results to the db file and save their offset
+                        ref_offset_dict[ref_id] = db_fp.tell()
+                        if shm_name:
+                            _dump_shared_ref_pos_list(db_fp, ref_pos_list, shm_name, layout)
+                        else:
+                            pickle.dump(ref_pos_list, db_fp, protocol=pickle.HIGHEST_PROTOCOL)
+                        pbar.update()
+                finally:
+                    # Cancel the pending references in case of error and release the shared memory of the completed ones
+                    result_iter.close()
+
+                # List the references in whitelist order whatever the order they were processed in
+                whitelist_rank = {ref_id: i for i, ref_id in enumerate(self.__whitelist.ref_id_list)}
+                ref_id_list.sort(key=whitelist_rank.get)
+                ref_offset_dict = OrderedDict((ref_id, ref_offset_dict[ref_id]) for ref_id in ref_id_list)
+
+                # Write index with list of refid, offsets and metadata at the end of the file
+                write_db_index(db_fp, {
+                    "ref_id_list": ref_id_list,
+                    "ref_offset": ref_offset_dict,
+                    "metadata": {
+                        "package_name": package_name,
+                        "package_version": package_version,
+                        "timestamp": str(datetime.datetime.now()),
+                        "comparison_methods": self.__comparison_methods,
+                        "pvalue_tests": sorted(list(pvalue_tests)),
+                        "sequence_context": self.__sequence_context,
+                        "min_coverage": self.__min_coverage,
+                        "n_samples": self.__n_samples}})
 
         # Catch error and reraise it
         except(BrokenPipeError, KeyboardInterrupt, NanocomporeError) as E:
@@ -249,14 +315,7 @@ class SampComp(object):
             raise E
 
         finally:
-            # Soft processes stopping
-            for ps in ps_list:
-                ps.join()
-
-            # Hard failsafe processes killing
-            for ps in ps_list:
-                if ps.exitcode == None:
-                    ps.terminate()
+            pbar.close()
 
         # Return database wrapper object
         return SampCompDB(
@@ -264,174 +323,24 @@ class SampComp(object):
             fasta_fn=self.__fasta_fn,
             bed_fn=self.__bed_fn)
 
-    #~~~~~~~~~~~~~~PRIVATE MULTIPROCESSING METHOD~~~~~~~~~~~~~~#
-    def __list_refid(self, in_q, error_q):
-        """Add valid refid from whitelist to input queue to dispatch the data among the workers"""
-        try:
-            for ref_id, ref_dict in self.__whitelist:
-                logger.debug("Adding {} to in_q".format(ref_id))
-                in_q.put((ref_id, ref_dict))
-
-            # Deal 1 poison pill and close file pointer
-            logger.debug("Adding poison pill to in_q")
-            for i in range(self.__nthreads):
-                in_q.put(None)
-
-        # Manage exceptions and deal poison pills
-        except Exception:
-            logger.debug("Error in Reader. Kill input queue")
-            for i in range(self.__nthreads):
-                in_q.put(None)
-            error_q.put(traceback.format_exc())
-
-    def __process_references(self, in_q, out_q, error_q):
+    #~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~#
+    @staticmethod
+    def precompute_cache(eventalign_fn_dict):
         """
-        Consume ref_id, agregate intensity and dwell time at position level and
-        perform statistical analyses to find significantly different regions
+        Convert once the eventalign_collapse files to a binary cache read directly by the SampComp workers instead
+        of parsing the text files. The cache of each file is saved next to it (fn.cache and fn.cache.idx.npy) and used
+        automatically by SampComp as long as it is more recent than the eventalign file.
+        * eventalign_fn_dict
+            Multilevel dictionnary indicating the condition_label, sample_label and file name of the eventalign_collapse output.
+            One can also pass YAML file describing the samples instead.
         """
-        try:
-            logger.debug("Worker thread started")
-            # Open all files for reading. File pointer are stored in a dict matching the ref_dict entries
-            fp_dict = self.__eventalign_fn_open()
-
-            # Process refid in input queue
-            for ref_id, ref_dict in iter(in_q.get, None):
-                logger.debug("Worker thread processing new item from in_q: {}".format(ref_id))
-                # Create an empty dict for all positions first
-                ref_pos_list = self.__make_ref_pos_list(ref_id)
-
-                for cond_lab, sample_dict in ref_dict.items():
-                    for sample_lab, read_list in sample_dict.items():
-                        fp = fp_dict[cond_lab][sample_lab]
-
-                        for read in read_list:
-
-                            # Move to read, save read data chunk and reset file pointer
-                            fp.seek(read["byte_offset"])
-                            line_list = fp.read(read["byte_len"]).split("\n")
-                            fp.seek(0)
-
-                            # Check read_id ref_id concordance between index and data file
-                            header = numeric_cast_list(line_list[0][1:].split("\t"))
-                            if not header[0] == read["read_id"] or not header[1] == read["ref_id"]:
-                                raise NanocomporeError("Index and data files are not matching:\n{}\n{}".format(header, read))
-
-                            # Extract col names from second line
-                            col_names = line_list[1].split("\t")
-                            # Check that all required fields are present
-                            if not all_values_in (["ref_pos", "ref_kmer", "median", "dwell_time"], col_names):
-                                raise NanocomporeError("Required fields not found in the data file: {}".format(col_names))
-                            # Verify if kmers events stats values are present or not
-                            kmers_stats = all_values_in (["NNNNN_dwell_time", "mismatch_dwell_time"], col_names)
-
-                            # Parse data files kmers per kmers
-                            prev_pos = None
-                            for line in line_list[2:]:
-                                # Transform line to dict and cast str numbers to actual numbers
-                                kmer = numeric_cast_dict(keys=col_names, values=line.split("\t"))
-                                pos = kmer["ref_pos"]
-
-                                # Check consistance between eventalign data and reference sequence
-                                if kmer["ref_kmer"] != ref_pos_list[pos]["ref_kmer"]:
-                                    ref_pos_list[pos]["ref_kmer"] = ref_pos_list[pos]["ref_kmer"]+"!!!!"
-                                    #raise NanocomporeError ("Data reference kmer({}) doesn't correspond to the reference sequence ({})".format(ref_pos_list[pos]["ref_kmer"], kmer["ref_kmer"]))
-
-                                # Fill dict with the current pos values
-                                ref_pos_list[pos]["data"][cond_lab][sample_lab]["intensity"].append(kmer["median"])
-                                ref_pos_list[pos]["data"][cond_lab][sample_lab]["dwell"].append(kmer["dwell_time"])
-                                ref_pos_list[pos]["data"][cond_lab][sample_lab]["coverage"] += 1
-
-                                if kmers_stats:
-                                    # Fill in the missing positions
-                                    if prev_pos and pos-prev_pos > 1:
-                                        for missing_pos in range(prev_pos+1, pos):
-                                            ref_pos_list[missing_pos]["data"][cond_lab][sample_lab]["kmers_stats"]["missing"] += 1
-                                    # Also fill in with normalised position event stats
-                                    n_valid = (kmer["dwell_time"]-(kmer["NNNNN_dwell_time"]+kmer["mismatch_dwell_time"])) / kmer["dwell_time"]
-                                    n_NNNNN = kmer["NNNNN_dwell_time"] / kmer["dwell_time"]
-                                    n_mismatching = kmer["mismatch_dwell_time"] / kmer["dwell_time"]
-                                    ref_pos_list[pos]["data"][cond_lab][sample_lab]["kmers_stats"]["valid"] += n_valid
-                                    ref_pos_list[pos]["data"][cond_lab][sample_lab]["kmers_stats"]["NNNNN"] += n_NNNNN
-                                    ref_pos_list[pos]["data"][cond_lab][sample_lab]["kmers_stats"]["mismatching"] += n_mismatching
-                                    # Save previous position
-                                    prev_pos = pos
-
-                logger.debug("Data for {} loaded.".format(ref_id))
-                if self.__comparison_methods:
-                    random_state=np.random.RandomState(seed=42)
-                    ref_pos_list = txCompare(
-                        ref_id=ref_id,
-                        ref_pos_list=ref_pos_list,
-                        methods=self.__comparison_methods,
-                        sequence_context=self.__sequence_context,
-                        sequence_context_weights=self.__sequence_context_weights,
-                        min_coverage= self.__min_coverage,
-                        allow_warnings=self.__allow_warnings,
-                        logit=self.__logit,
-                        random_state=random_state)
-
-                # Add the current read details to queue
-                logger.debug("Adding %s to out_q"%(ref_id))
-                out_q.put((ref_id, ref_pos_list))
-
-            # Deal 1 poison pill and close file pointer
-            logger.debug("Adding poison pill to out_q")
-            out_q.put(None)
-            self.__eventalign_fn_close(fp_dict)
-
-        # Manage exceptions, deal poison pills and close files
-        except Exception as e:
-            logger.error("Error in worker. Kill output queue")
-            logger.error(e)
-            for i in range(self.__nthreads):
-                out_q.put(None)
-            self.__eventalign_fn_close(fp_dict)
-            error_q.put(traceback.format_exc())
-
-    def __write_output(self, out_q, error_q):
-        # Get results out of the out queue and write in shelve
-        pvalue_tests = set()
-        ref_id_list = []
-        try:
-            with shelve.open(self.__db_fn, flag='n') as db:
-                # Iterate over the counter queue and process items until all poison pills are found
-                pbar = tqdm(total = len(self.__whitelist), unit=" Processed References", disable=self.__log_level in ("warning", "debug"))
-                for _ in range(self.__nthreads):
-                    for ref_id, ref_pos_list in iter(out_q.get, None):
-                        ref_id_list.append(ref_id)
-                        logger.debug("Writer thread writing %s"%ref_id)
-                        # Get pvalue fields available in analysed data before
-                        for pos_dict in ref_pos_list:
-                            if 'txComp' in pos_dict:
-                                for res in pos_dict['txComp'].keys():
-                                    if "pvalue" in res:
-                                        pvalue_tests.add(res)
-                        # Write results in a shelve db
-                        db [ref_id] = ref_pos_list
-                        pbar.update()
-
-                # Write list of refid
-                db["__ref_id_list"] = ref_id_list
-
-                # Write metadata
-                db["__metadata"] = {
-                    "package_name": package_name,
-                    "package_version": package_version,
-                    "timestamp": str(datetime.datetime.now()),
-                    "comparison_methods": self.__comparison_methods,
-                    "pvalue_tests": sorted(list(pvalue_tests)),
-                    "sequence_context": self.__sequence_context,
-                    "min_coverage": self.__min_coverage,
-                    "n_samples": self.__n_samples}
-
-            # Ending process bar and deal poison pill in error queue
-            pbar.close()
-            error_q.put(None)
-
-        # Manage exceptions and add error trackback to error queue
-        except Exception:
-            pbar.close()
-            error_q.put(traceback.format_exc())
+        if type(eventalign_fn_dict) == str:
+            with open(eventalign_fn_dict, "r") as fp:
+                eventalign_fn_dict = yaml.load(fp, Loader=yaml.SafeLoader)
+        for sample_dict in eventalign_fn_dict.values():
+            for fn in sample_dict.values():
+                logger.info("Writing binary cache for {}".format(fn))
+                _write_eventalign_cache(fn)
 
     #~~~~~~~~~~~~~~PRIVATE HELPER METHODS~~~~~~~~~~~~~~#
     def __check_eventalign_fn_dict(self, d):
@@ -471,41 +380,473 @@ class SampComp(object):
                     d_clean[cond_lab]["{}_{}".format(cond_lab, rep_lab)] = fn
             return d_clean
 
-    def __eventalign_fn_open(self):
-        """"""
-        fp_dict = OrderedDict()
-        for cond_lab, sample_dict in self.__eventalign_fn_dict.items():
-            fp_dict[cond_lab] = OrderedDict()
-            for sample_lab, fn in sample_dict.items():
-                fp_dict[cond_lab][sample_lab] = open(fn, "r")
-        return fp_dict
-
-    def __eventalign_fn_close(self, fp_dict):
-        """"""
-        for sample_dict in fp_dict.values():
-            for fp in sample_dict.values():
-                fp.close()
-
-    def __make_ref_pos_list(self, ref_id):
-        """"""
-        ref_pos_list = []
-        with Fasta(self.__fasta_fn) as fasta:
-            ref_fasta = fasta [ref_id]
-            ref_len = len(ref_fasta)
-            ref_seq = str(ref_fasta)
-
-            for pos in range(ref_len-4):
-                pos_dict = OrderedDict()
-                pos_dict["ref_kmer"] = ref_seq[pos:pos+5]
-                pos_dict["data"] = OrderedDict()
-                for cond_lab, s_dict in self.__eventalign_fn_dict.items():
-                    pos_dict["data"][cond_lab] = OrderedDict()
-                    for sample_lab in s_dict.keys():
-
-                        pos_dict["data"][cond_lab][sample_lab] = {
-                            "intensity":[],
-                            "dwell":[],
-                            "coverage":0,
-                            "kmers_stats":{"missing":0,"valid":0,"NNNNN":0,"mismatching":0}}
-                ref_pos_list.append(pos_dict)
-        return ref_pos_list
+#~~~~~~~~~~~~~~PRIVATE FUNCTIONS~~~~~~~~~~~~~~#
+_EMPTY_FLOAT_ARR = np.empty(0, dtype=np.float32)
+
+# Largest reference arrays buffer allocated in shared memory. Larger ones are pickled back to the main process
+_SHM_MAX_NBYTES = 512*1024*1024
+
+# Options needed by the workers. Only this small picklable record is sent to the worker processes, not the SampComp object
+_WorkerCfg = namedtuple("_WorkerCfg", [
+    "eventalign_fn_dict",
+    "fasta_fn",
+    "comparison_methods",
+    "sequence_context",
+    "sequence_context_weights",
+    "min_coverage",
+    "allow_warnings",
+    "logit",
+    "max_pending"])
+
+# Per worker process state set by _init_worker
+_worker_cfg = None
+_worker_mm_dict = None
+_worker_cache_dict = None
+_worker_fasta = None
+_worker_random_state = None
+
+def _make_executor(max_workers, worker_cfg):
+    """Create the pool of worker processes. The worker state is initialised once per process"""
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(worker_cfg,))
+    # Python < 3.7 does not support initializer. Init the state in the main process to be inherited by the forked workers
+    except TypeError:
+        _init_worker(worker_cfg)
+        return ProcessPoolExecutor(max_workers=max_workers)
+
+def _init_worker(worker_cfg):
+    """
+    Memory map all the eventalign files, or their binary cache if valid, and open the reference fasta once
+    per worker process. The mmap objects keep their own file descriptor and are released when the process exits
+    """
+    global _worker_cfg, _worker_mm_dict, _worker_cache_dict, _worker_fasta, _worker_random_state
+    # Dump the python traceback if a worker crashes in compiled code
+    faulthandler.enable()
+    logger.debug("Worker process started")
+    _worker_cfg = worker_cfg
+    _worker_mm_dict = OrderedDict()
+    _worker_cache_dict = OrderedDict()
+    for cond_lab, sample_dict in worker_cfg.eventalign_fn_dict.items():
+        _worker_mm_dict[cond_lab] = OrderedDict()
+        _worker_cache_dict[cond_lab] = OrderedDict()
+        for sample_lab, fn in sample_dict.items():
+            if _has_eventalign_cache(fn):
+                _worker_cache_dict[cond_lab][sample_lab] = _open_eventalign_cache(fn)
+            else:
+                with open(fn, "rb") as fp:
+                    _worker_mm_dict[cond_lab][sample_lab] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_fasta = Fasta(worker_cfg.fasta_fn, as_raw=True)
+    _worker_random_state = np.random.RandomState()
+
+def _process_ref_task(ref_id, ref_dict):
+    """
+    Pool task processing a reference. Return the position dicts and the name and layout of the shared memory
+    block holding the arrays (None if shared memory is not available). Errors are reraised as NanocomporeError
+    """
+    try:
+        logger.debug("Worker processing {}".format(ref_id))
+        ref_pos_list, shm, layout = _process_ref(ref_id, ref_dict)
+        if shm:
+            # The block is unlinked by the main process once written
+            shm_name = shm.name
+            shm.close()
+            return ref_id, ref_pos_list, shm_name, layout
+        return ref_id, ref_pos_list, None, None
+    except Exception:
+        logger.error("Error in worker while processing {}".format(ref_id))
+        raise NanocomporeError(traceback.format_exc())
+
+def _process_ref(ref_id, ref_dict):
+    """
+    Agregate the reads data of a reference in per sample arrays and run the comparison tests.
+    If shared memory is available, the arrays live in a shared memory block and the intensity
+    and dwell views are removed from the returned position dicts
+    """
+    # Preallocate per sample arrays for all positions first
+    ref_kmer_list, ref_arrays, shm, layout = _make_ref_arrays(ref_id, ref_dict, _worker_fasta, _worker_cfg.eventalign_fn_dict, _worker_cfg.max_pending)
+
+    try:
+        _fill_ref_arrays(ref_dict, ref_kmer_list, ref_arrays)
+        # Expose the arrays as the per position list of dict used downstream
+        ref_pos_list = _make_ref_pos_list(ref_kmer_list, ref_arrays)
+
+        logger.debug("Data for {} loaded.".format(ref_id))
+        if _worker_cfg.comparison_methods:
+            # Reseed for each reference so that the results don't depend on the order the workers process them
+            _worker_random_state.seed(42)
+            ref_pos_list = txCompare(
+                ref_id=ref_id,
+                ref_pos_list=ref_pos_list,
+                methods=_worker_cfg.comparison_methods,
+                sequence_context=_worker_cfg.sequence_context,
+                sequence_context_weights=_worker_cfg.sequence_context_weights,
+                min_coverage=_worker_cfg.min_coverage,
+                allow_warnings=_worker_cfg.allow_warnings,
+                logit=_worker_cfg.logit,
+                random_state=_worker_random_state)
+    # Release the shared memory block if the reference cannot be processed
+    except Exception:
+        if shm:
+            shm.unlink()
+        raise
+
+    # Drop the views on the shared memory block. They are rebuilt by the main process from the layout
+    if shm:
+        _set_ref_pos_arrays(ref_pos_list, None)
+    return ref_pos_list, shm, layout
+
+def _fill_ref_arrays(ref_dict, ref_kmer_list, ref_arrays):
+    """Get the data of all the reads of a reference from the mapped eventalign files or caches and store them in the per sample arrays"""
+    # Reference kmers as fixed size bytes to compare with the kmers of the reads in bulk
+    ref_kmer_arr = np.array(ref_kmer_list, dtype="S5")
+    kmer_mismatch = np.zeros(len(ref_kmer_list), dtype=bool)
+
+    for cond_lab, sample_dict in ref_dict.items():
+        for sample_lab, read_list in sample_dict.items():
+            cache = _worker_cache_dict[cond_lab].get(sample_lab)
+            mm = _worker_mm_dict[cond_lab].get(sample_lab)
+            sample_arrays = ref_arrays[cond_lab][sample_lab]
+
+            # Access the reads in file order to read the mapped file sequentially
+            for read in sorted(read_list, key=lambda r: r["byte_offset"]):
+                if cache:
+                    read_data, kmers_stats = _read_cache_data(cache, read)
+                else:
+                    read_data, kmers_stats = _read_mm_data(mm, read)
+                pos = read_data["ref_pos"]
+
+                # The positions are used as write cursors in the arrays, so they must be unique and within the reference
+                if pos.size and (pos[0] < 0 or pos.max() >= len(ref_kmer_list) or (np.diff(pos) <= 0).any()):
+                    raise NanocomporeError("The positions of read {} are not sorted, unique and within the reference".format(read["read_id"]))
+
+                # Check consistance between eventalign data and reference sequence
+                kmer_mismatch[pos[read_data["ref_kmer"] != ref_kmer_arr[pos]]] = True
+
+                # Store the read values in the next free slot of each position and fill kmers stats
+                _accumulate_read(
+                    pos,
+                    read_data["median"],
+                    read_data["dwell_time"],
+                    read_data.get("NNNNN_dwell_time", _EMPTY_FLOAT_ARR),
+                    read_data.get("mismatch_dwell_time", _EMPTY_FLOAT_ARR),
+                    sample_arrays["intensity"],
+                    sample_arrays["dwell"],
+                    sample_arrays["coverage"],
+                    sample_arrays["kmers_stats"],
+                    kmers_stats)
+
+    # Flag the reference kmers which don't correspond to the eventalign data
+    for p in np.nonzero(kmer_mismatch)[0]:
+        ref_kmer_list[p] = ref_kmer_list[p]+"!!!!"
+
+def _read_mm_data(mm, read):
+    """Parse the data chunk of a read from a memory mapped eventalign file. Return the dict of column arrays and the kmers stats flag"""
+    # Slice the read data chunk bytes out of the mapped file
+    line_list = mm[read["byte_offset"]:read["byte_offset"]+read["byte_len"]].split(b"\n", 2)
+
+    # Check read_id ref_id concordance between index and data file
+    header = numeric_cast_list(line_list[0][1:].decode().split("\t"))
+    if not header[0] == read["read_id"] or not header[1] == read["ref_id"]:
+        raise NanocomporeError("Index and data files are not matching:\n{}\n{}".format(header, read))
+
+    # Extract col names from second line
+    col_names, kmers_stats = _parse_col_names(line_list[1])
+
+    # Parse all the kmers of the read at once
+    read_data = _parse_read_chunk(line_list[2] if len(line_list) > 2 else b"", col_names, kmers_stats)
+    return read_data, kmers_stats
+
+@lru_cache(maxsize=None)
+def _parse_col_names(line):
+    """
+    Decode and check the col names line (bytes) of a read data chunk and verify if kmers events stats values are present.
+    The line is the same for all the reads of a file, so the result is memoised
+    """
+    col_names = line.decode().split("\t")
+    # Check that all required fields are present
+    if not all_values_in (["ref_pos", "ref_kmer", "median", "dwell_time"], col_names):
+        raise NanocomporeError("Required fields not found in the data file: {}".format(col_names))
+    kmers_stats = all_values_in (["NNNNN_dwell_time", "mismatch_dwell_time"], col_names)
+    return col_names, kmers_stats
+
+def _read_cache_data(cache, read):
+    """Get the data of a read from an eventalign binary cache. Return the dict of column arrays and the kmers stats flag"""
+    records, cache_idx = cache
+    # The cache index is sorted by byte offset of the reads in the eventalign file
+    i = np.searchsorted(cache_idx["byte_offset"], read["byte_offset"])
+    if i == len(cache_idx) or cache_idx["byte_offset"][i] != read["byte_offset"]:
+        raise NanocomporeError("Index and cache files are not matching:\n{}".format(read))
+    row_start, n_rows, kmers_stats = cache_idx[["row_start", "n_rows", "kmers_stats"]][i].tolist()
+
+    rec = records[row_start:row_start+n_rows]
+    read_data = {
+        "ref_pos": np.ascontiguousarray(rec["ref_pos"]),
+        "ref_kmer": rec["ref_kmer"],
+        "median": np.ascontiguousarray(rec["median"]),
+        "dwell_time": np.ascontiguousarray(rec["dwell_time"])}
+    if kmers_stats:
+        read_data["NNNNN_dwell_time"] = np.ascontiguousarray(rec["NNNNN_dwell_time"])
+        read_data["mismatch_dwell_time"] = np.ascontiguousarray(rec["mismatch_dwell_time"])
+    return read_data, kmers_stats
+
+def _has_eventalign_cache(fn):
+    """Check if the binary cache files of an eventalign file exist and are more recent than the eventalign file"""
+    for cache_fn in (fn+".cache", fn+".cache.idx.npy"):
+        if not os.path.isfile(cache_fn) or os.path.getmtime(cache_fn) < os.path.getmtime(fn):
+            return False
+    return True
+
+def _open_eventalign_cache(fn):
+    """Memory map the records of the binary cache of an eventalign file and load its index after checking that they match"""
+    cache_idx = np.load(fn+".cache.idx.npy")
+    cache_size = os.path.getsize(fn+".cache")
+    if cache_idx.dtype != EVENTALIGN_CACHE_IDX_DTYPE or cache_size != cache_idx["n_rows"].sum()*EVENTALIGN_CACHE_DTYPE.itemsize:
+        raise NanocomporeError("The binary cache of {} is not valid. Regenerate it with SampComp.precompute_cache".format(fn))
+    # np.memmap cannot map empty files
+    if not cache_size:
+        return np.empty(0, dtype=EVENTALIGN_CACHE_DTYPE), cache_idx
+    return np.memmap(fn+".cache", dtype=EVENTALIGN_CACHE_DTYPE, mode="r"), cache_idx
+
+def _write_eventalign_cache(fn):
+    """
+    Parse all the reads listed in the index of an eventalign file and write their data as EVENTALIGN_CACHE_DTYPE records in fn.cache,
+    in the order of the file. The per read row range and kmers stats flag are saved with the read byte offset in fn.cache.idx.npy
+    """
+    # Read the index the same way as Whitelist to get identical read_id and ref_id types
+    with open(fn+".idx") as fp:
+        col_names = fp.readline().rstrip().split()
+        read_list = [numeric_cast_dict(keys=col_names, values=line.rstrip().split("\t")) for line in fp]
+    read_list.sort(key=lambda read: read["byte_offset"])
+    cache_idx = np.empty(len(read_list), dtype=EVENTALIGN_CACHE_IDX_DTYPE)
+
+    row_start = 0
+    with open(fn, "rb") as fp, open(fn+".cache", "wb") as cache_fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i, read in enumerate(read_list):
+                read_data, kmers_stats = _read_mm_data(mm, read)
+                rec = np.zeros(len(read_data["ref_pos"]), dtype=EVENTALIGN_CACHE_DTYPE)
+                for field, values in read_data.items():
+                    rec[field] = values
+                rec.tofile(cache_fp)
+                cache_idx[i] = (read["byte_offset"], row_start, len(rec), kmers_stats)
+                row_start += len(rec)
+        finally:
+            mm.close()
+    np.save(fn+".cache.idx.npy", cache_idx)
+
+def _make_ref_arrays(ref_id, ref_dict, fasta, eventalign_fn_dict, max_pending=1):
+    """
+    Preallocate per sample arrays (structure of arrays) to store the data of all
+    the positions of a reference. The intensity and dwell arrays are sized from
+    the number of reads of each sample in the whitelist. All the arrays are views
+    of a single zero initialised buffer, allocated in shared memory if available
+    and if max_pending blocks of the same size fit in it (see _shared_memory_fits).
+    fasta is a pyfaidx Fasta object opened with as_raw=True
+    """
+    ref_seq = fasta [ref_id][:]
+    n_pos = len(ref_seq)-4
+    ref_kmer_list = [ref_seq[pos:pos+5] for pos in range(n_pos)]
+
+    array_list = []
+    for cond_lab, s_dict in eventalign_fn_dict.items():
+        for sample_lab in s_dict.keys():
+            n_reads = len(ref_dict[cond_lab][sample_lab])
+            array_list.append((cond_lab, sample_lab, "intensity", (n_pos, n_reads), np.float32))
+            array_list.append((cond_lab, sample_lab, "dwell", (n_pos, n_reads), np.float32))
+            array_list.append((cond_lab, sample_lab, "coverage", (n_pos,), np.int32))
+            array_list.append((cond_lab, sample_lab, "kmers_stats", (n_pos, 4), np.float64))
+    layout, nbytes = _make_array_layout(array_list)
+
+    if shared_memory and _shared_memory_fits(nbytes, max_pending):
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        ref_arrays = _arrays_from_buffer(shm.buf, layout)
+    else:
+        shm = None
+        ref_arrays = _arrays_from_buffer(bytearray(max(nbytes, 1)), layout)
+    return ref_kmer_list, ref_arrays, shm, layout
+
+def _shared_memory_fits(nbytes, max_pending):
+    """
+    Check that a buffer of nbytes can be allocated in shared memory. The shared memory filesystem allocates the pages
+    when they are written, so a block exceeding the free space is created but the worker is killed by SIGBUS when filling it.
+    The free space must hold max_pending blocks of the same size, as up to max_pending references can be in flight
+    """
+    if nbytes > _SHM_MAX_NBYTES:
+        return False
+    try:
+        st = os.statvfs("/dev/shm")
+    # Cannot check the free space on systems without /dev/shm
+    except (OSError, AttributeError):
+        return True
+    return nbytes*max_pending <= st.f_bavail*st.f_frsize
+
+def _make_array_layout(array_list):
+    """
+    Compute the 8 bytes aligned offsets of a list of (cond_lab, sample_lab, field, shape, dtype) arrays
+    packed in a single buffer. Return the picklable layout and the total buffer size in bytes
+    """
+    layout = []
+    offset = 0
+    for cond_lab, sample_lab, field, shape, dtype in array_list:
+        dtype = np.dtype(dtype)
+        layout.append((cond_lab, sample_lab, field, shape, dtype.str, offset))
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        offset += (nbytes+7)//8*8
+    return layout, offset
+
+def _arrays_from_buffer(buf, layout):
+    """Create the nested dict of per sample arrays viewing a buffer following a layout from _make_array_layout"""
+    ref_arrays = OrderedDict()
+    for cond_lab, sample_lab, field, shape, dtype, offset in layout:
+        sample_arrays = ref_arrays.setdefault(cond_lab, OrderedDict()).setdefault(sample_lab, {})
+        sample_arrays[field] = np.ndarray(shape=shape, dtype=dtype, buffer=buf, offset=offset)
+    return ref_arrays
+
+def _make_ref_pos_list(ref_kmer_list, ref_arrays):
+    """Build the list of position dict from the per sample arrays. Intensity and dwell are views of the arrays"""
+    # Convert the per position scalars to lists once per sample instead of indexing the arrays for every position
+    sample_list = []
+    for cond_lab, s_dict in ref_arrays.items():
+        for sample_lab, sample_arrays in s_dict.items():
+            sample_list.append((
+                cond_lab,
+                sample_lab,
+                sample_arrays["intensity"],
+                sample_arrays["dwell"],
+                sample_arrays["coverage"].tolist(),
+                sample_arrays["kmers_stats"].tolist()))
+
+    ref_pos_list = []
+    for pos, ref_kmer in enumerate(ref_kmer_list):
+        data = OrderedDict((cond_lab, OrderedDict()) for cond_lab in ref_arrays.keys())
+        for cond_lab, sample_lab, intensity, dwell, coverage, kmers_stats in sample_list:
+            cov = coverage[pos]
+            missing, valid, NNNNN, mismatching = kmers_stats[pos]
+            data[cond_lab][sample_lab] = {
+                "intensity":intensity[pos, :cov],
+                "dwell":dwell[pos, :cov],
+                "coverage":cov,
+                "kmers_stats":{"missing":int(missing),"valid":valid,"NNNNN":NNNNN,"mismatching":mismatching}}
+        ref_pos_list.append(OrderedDict((("ref_kmer", ref_kmer), ("data", data))))
+    return ref_pos_list
+
+def _set_ref_pos_arrays(ref_pos_list, ref_arrays):
+    """Replace in place the intensity and dwell of the position dicts by views of the per sample arrays or by None if ref_arrays is None"""
+    for pos, pos_dict in enumerate(ref_pos_list):
+        for cond_lab, s_dict in pos_dict["data"].items():
+            for sample_lab, sample_dict in s_dict.items():
+                if ref_arrays is None:
+                    sample_dict["intensity"] = sample_dict["dwell"] = None
+                else:
+                    cov = sample_dict["coverage"]
+                    sample_arrays = ref_arrays[cond_lab][sample_lab]
+                    sample_dict["intensity"] = sample_arrays["intensity"][pos, :cov]
+                    sample_dict["dwell"] = sample_arrays["dwell"][pos, :cov]
+
+def _dump_shared_ref_pos_list(fp, ref_pos_list, shm_name, layout):
+    """Attach the shared memory block filled by a worker, pickle the full position dicts in fp then release the block"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _set_ref_pos_arrays(ref_pos_list, _arrays_from_buffer(shm.buf, layout))
+        pickle.dump(ref_pos_list, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        # Views must be released before closing the block
+        _set_ref_pos_arrays(ref_pos_list, None)
+        shm.close()
+        shm.unlink()
+
+def _discard_ref_result(result):
+    """Release the shared memory block of a _process_ref_task result which is not written to the database"""
+    ref_id, ref_pos_list, shm_name, layout = result
+    if shm_name:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shm.close()
+        shm.unlink()
+
+def _accumulate_read_numpy(pos, median, dwell, NNNNN_dwell, mismatch_dwell, intensity_arr, dwell_arr, coverage, kmers_stats_arr, kmers_stats):
+    """
+    Store the values of one read in the next free slot of each position of the sample arrays.
+    The coverage vector is used as a per position fill cursor. Positions must be sorted and unique within a read (checked by _fill_ref_arrays).
+    If kmers_stats is True, also fill in the missing positions and the normalised position event stats
+    """
+    cursor = coverage[pos]
+    intensity_arr[pos, cursor] = median
+    dwell_arr[pos, cursor] = dwell
+    coverage[pos] += 1
+
+    if kmers_stats and pos.size:
+        # Fill in the missing positions. The gaps of a read do not overlap so all the positions are unique
+        gap_idx = np.nonzero(np.diff(pos) > 1)[0]
+        if gap_idx.size:
+            gap_start = pos[gap_idx]+1
+            gap_len = pos[gap_idx+1]-gap_start
+            missing_pos = np.arange(gap_len.sum()) + np.repeat(gap_start-(np.cumsum(gap_len)-gap_len), gap_len)
+            kmers_stats_arr[missing_pos, 0] += 1
+        # Also fill in with normalised position event stats
+        kmers_stats_arr[pos, 1] += (dwell-(NNNNN_dwell+mismatch_dwell)) / dwell
+        kmers_stats_arr[pos, 2] += NNNNN_dwell / dwell
+        kmers_stats_arr[pos, 3] += mismatch_dwell / dwell
+
+def _accumulate_read_loop(pos, median, dwell, NNNNN_dwell, mismatch_dwell, intensity_arr, dwell_arr, coverage, kmers_stats_arr, kmers_stats):
+    """Explicit loop version of _accumulate_read_numpy meant to be compiled with numba"""
+    prev_pos = -1
+    for i in range(pos.shape[0]):
+        p = pos[i]
+        c = coverage[p]
+        intensity_arr[p, c] = median[i]
+        dwell_arr[p, c] = dwell[i]
+        coverage[p] = c+1
+
+        if kmers_stats:
+            # Fill in the missing positions
+            if prev_pos >= 0:
+                for missing_pos in range(prev_pos+1, p):
+                    kmers_stats_arr[missing_pos, 0] += 1
+            # Also fill in with normalised position event stats
+            kmers_stats_arr[p, 1] += (dwell[i]-(NNNNN_dwell[i]+mismatch_dwell[i])) / dwell[i]
+            kmers_stats_arr[p, 2] += NNNNN_dwell[i] / dwell[i]
+            kmers_stats_arr[p, 3] += mismatch_dwell[i] / dwell[i]
+            prev_pos = p
+
+# Use the compiled loop if numba is available and fall back to numpy vectorisation otherwise.
+# Bounds checking is disabled as _fill_ref_arrays validates the positions of each read before calling it
+if numba:
+    _accumulate_read = numba.njit(cache=True, boundscheck=False, nogil=True)(_accumulate_read_loop)
+else:
+    _accumulate_read = _accumulate_read_numpy
+
+def _warmup_accumulate_read():
+    """Call _accumulate_read once on dummy arrays to trigger (or load from cache) the JIT compilation"""
+    _accumulate_read(
+        np.zeros(1, dtype=np.int64),
+        np.ones(1, dtype=np.float32),
+        np.ones(1, dtype=np.float32),
+        np.zeros(1, dtype=np.float32),
+        np.zeros(1, dtype=np.float32),
+        np.empty((1, 1), dtype=np.float32),
+        np.empty((1, 1), dtype=np.float32),
+        np.zeros(1, dtype=np.int32),
+        np.zeros((1, 4), dtype=np.float64),
+        True)
+
+def _parse_read_chunk(buf, col_names, kmers_stats=False):
+    """
+    Parse the kmer lines (bytes) of a read data chunk in bulk with the pandas C parser.
+    Return a dict of numpy arrays for ref_pos, ref_kmer, median, dwell_time and
+    if kmers_stats is True NNNNN_dwell_time and mismatch_dwell_time. Values are parsed as float32 and kmers as 5 bytes strings
+    """
+    usecols = ["ref_pos", "ref_kmer", "median", "dwell_time"]
+    if kmers_stats:
+        usecols.extend(["NNNNN_dwell_time", "mismatch_dwell_time"])
+    dtype = {col:np.float32 for col in usecols}
+    dtype["ref_pos"] = np.int64
+    dtype["ref_kmer"] = str
+
+    if not buf.strip():
+        read_data = {col:np.empty(0, dtype=dtype[col]) for col in usecols}
+    else:
+        df = pd.read_csv(io.BytesIO(buf), sep="\t", header=None, names=col_names, usecols=usecols, dtype=dtype, engine="c", na_filter=False, float_precision="round_trip")
+        read_data = {col:df[col].values for col in usecols}
+    read_data["ref_kmer"] = read_data["ref_kmer"].astype("S5")
+    return read_data
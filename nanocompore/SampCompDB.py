@@ -4,8 +4,8 @@
 # Std lib
 from loguru import logger
 from collections import *
-import shelve
-from dbm import error as dbm_error
+import pickle
+import struct
 from math import log
 import re
 import sys
@@ -31,7 +31,7 @@ from nanocompore.common import *
 
 #~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~#
 class SampCompDB(object):
-    """ Wrapper over the result shelve SampComp """
+    """ Wrapper over the result database of SampComp """
 
     #~~~~~~~~~~~~~~FUNDAMENTAL METHODS~~~~~~~~~~~~~~#
     def __init__(self,
@@ -40,8 +40,8 @@ class SampCompDB(object):
         bed_fn:str = None,
         run_type:str = "RNA"):
         """
-        Import a shelve db and a fasta reference file. Automatically returned by SampComp
-        Can also be manually created from an existing shelve db output
+        Import a result db and a fasta reference file. Automatically returned by SampComp
+        Can also be manually created from an existing db output
         * db_fn
             Path to a database file previously created with SampComp
         * fasta_fn
@@ -54,27 +54,26 @@ class SampCompDB(object):
 
         logger.info("Loading SampCompDB")
 
-        # Try to get ref_id list and metadata from shelve db
+        # Try to get ref_id list, offsets and metadata from the db index
         try:
-            with shelve.open(db_fn, flag='r') as db:
-                # Try to get metadata from db
-                try:
-                    logger.debug("\tReading Metadata")
-                    self._metadata = db['__metadata']
-                except KeyError:
-                    raise NanocomporeError("The result database does not contain metadata")
-                # Try to load read_ids
-                try:
-                    logger.debug("\tLoading list of reference ids")
-                    self.ref_id_list = db['__ref_id_list']
-                except KeyError:
-                    logger.debug("\tCannot find the ref_id_list in shelve. Try to build the list from entries")
-                    self.ref_id_list = [k for k in db.keys() if k not in  ['__metadata', '__ref_id_list']]
-                if not self.ref_id_list:
-                    logger.info("The result database is empty")
-                    return None
-        except dbm_error:
+            with open(db_fn, "rb") as db_fp:
+                logger.debug("\tReading database index")
+                db_index = read_db_index(db_fp)
+        except (OSError, EOFError, pickle.UnpicklingError, struct.error):
             raise NanocomporeError("The result database cannot be opened")
+        # Try to get metadata from db
+        try:
+            logger.debug("\tReading Metadata")
+            self._metadata = db_index["metadata"]
+        except KeyError:
+            raise NanocomporeError("The result database does not contain metadata")
+        # Load read_ids and their offset in the db
+        logger.debug("\tLoading list of reference ids")
+        self.ref_id_list = db_index["ref_id_list"]
+        self._ref_offset = db_index["ref_offset"]
+        if not self.ref_id_list:
+            logger.info("The result database is empty")
+            return None
 
         # Save db prefix and db path
         self._db_fn = db_fn
@@ -113,17 +112,16 @@ class SampCompDB(object):
         return len(self.ref_id_list)
 
     def __iter__(self):
-        with shelve.open(self._db_fn, flag = "r") as db:
-            for k, v in db.items():
-                if not k in  ['__metadata', '__ref_id_list']:
-                    yield(k, v)
+        with open(self._db_fn, "rb") as db_fp:
+            for ref_id in self.ref_id_list:
+                yield(ref_id, read_db_item(db_fp, self._ref_offset[ref_id]))
 
     def __getitem__(self, items):
-        with shelve.open(self._db_fn, flag = "r") as db:
-            if items in db:
-                return db[items]
-            else:
-                raise KeyError("Item not found in the database")
+        if items in self._ref_offset:
+            with open(self._db_fn, "rb") as db_fp:
+                return read_db_item(db_fp, self._ref_offset[items])
+        else:
+            raise KeyError("Item not found in the database")
 
     #~~~~~~~~~~~~~~PRIVATE  METHODS~~~~~~~~~~~~~~#
 
@@ -356,7 +354,7 @@ class SampCompDB(object):
 
         headers = ['pos', 'chr', 'genomicPos', 'ref_id', 'strand', 'ref_kmer']+self._metadata["pvalue_tests"]
 
-        # Read extra GMM info from the shelve
+        # Read extra GMM info from the db
         if "GMM" in self._metadata["comparison_methods"]:
             headers.extend(["GMM_cov_type", "GMM_n_clust", "cluster_counts"])
             # Conditional add if logit or Anova
@@ -592,11 +590,11 @@ class SampCompDB(object):
                     lab = "{}_{}".format(cond_lab, sample_lab) if split_samples else cond_lab
 
                     # Add intensity and dwell values to list for curent pos / lab
-                    if not sample_val["intensity"]:
+                    if len(sample_val["intensity"]) == 0:
                         l_intensity.append((pos, lab, None))
                     for value in sample_val["intensity"]:
                         l_intensity.append((pos, lab, value))
-                    if not sample_val["dwell"]:
+                    if len(sample_val["dwell"]) == 0:
                         l_dwell.append((pos, lab, None))
                     for value in sample_val["dwell"]:
                         l_dwell.append((pos, lab, np.log10(value)))
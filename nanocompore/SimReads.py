@@ -8,6 +8,10 @@ from pkg_resources import resource_filename
 import json
 import datetime
 import os
+from concurrent.futures import ProcessPoolExecutor
+import bisect
+from functools import lru_cache
+from contextlib import ExitStack
 
 # Third party
 import numpy as np
@@ -16,7 +20,6 @@ from pyfaidx import Fasta
 import pyfaidx
 from scipy.stats import logistic as sp_logistic
 from scipy.stats import wald as sp_wald
-import matplotlib.pyplot as pl
 from tqdm import tqdm
 
 # Local package
@@ -29,6 +32,13 @@ logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 log_level_dict = {"debug":logging.DEBUG, "info":logging.INFO, "warning":logging.WARNING}
 
+# 2 bits code of the bases used to index the kmers model table. Other characters are coded -1
+base_code_array = np.full(256, -1, dtype=np.int64)
+base_code_array[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+
+# Default upper bound of the sampled values
+float64_max = np.finfo(np.float64).max
+
 #~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~#
 def SimReads(
     fasta_fn:str,
@@ -49,6 +59,8 @@ def SimReads(
     pos_rand_seed:int = 42,
     data_rand_seed:int = None,
     not_bound:bool = False,
+    nthreads:int = 1,
+    write_cache:bool = False,
     log_level:str = "info"):
     """
     Simulate reads in a NanopolishComp like file from a fasta file and an inbuild model.
@@ -91,6 +103,10 @@ def SimReads(
         Define a seed for generating the data. If None (default) the seed is drawn from /dev/urandom.
     * not_bound
         Do not bind the values generated by the distributions to the observed min and max observed values from the model file.
+    * nthreads
+        Number of processes used to simulate the references in parallel. With 1 all the references are simulated in the main process.
+    * write_cache
+        Also write the simulated data in the binary cache format of SampComp.precompute_cache, which SampComp then uses instead of parsing the text file.
     * log_level
         Set the log level {warning, info, debug}
     """
@@ -127,17 +143,24 @@ def SimReads(
     if run_type == "RNA":
         logger.info("Importing RNA model file")
         model_fn = resource_filename("nanocompore", "models/kmers_model_RNA_r9.4_180mv.tsv")
-        model_df = pd.read_csv(model_fn, sep="\t", comment="#", index_col=0)
+        # Parse the model once. Forked worker processes inherit the cached table
+        load_model_table(model_fn)
     else:
         raise NanocomporeError("Only RNA is implemented at the moment")
 
     # Open fasta file and output files
     logger.info("Reading Fasta file and simulate corresponding data")
 
-    with pyfaidx.Fasta(fasta_fn) as fasta_fp,\
-         open(os.path.join(outpath, "{}.tsv".format(outprefix)) , "w") as data_fp,\
+    data_fn = os.path.join(outpath, "{}.tsv".format(outprefix))
+    cache_idx_list = []
+    with pyfaidx.Fasta(fasta_fn, as_raw=True) as fasta_fp,\
+         open(data_fn, "wb", buffering=4*1024*1024) as data_fp,\
          open(os.path.join(outpath, "{}.tsv.idx".format(outprefix)), "w") as idx_fp,\
-         open(os.path.join(outpath, "{}_pos.tsv".format(outprefix)), "w") as pos_fp:
+         open(os.path.join(outpath, "{}_pos.tsv".format(outprefix)), "w") as pos_fp,\
+         ExitStack() as exit_stack:
+
+        # The binary cache file is only opened if required
+        cache_fp = exit_stack.enter_context(open(data_fn+".cache", "wb")) if write_cache else None
 
         # Get all reference names if no ref_list
         if not ref_list:
@@ -147,70 +170,90 @@ def SimReads(
         idx_fp.write("ref_id\tread_id\tbyte_offset\tbyte_len\n")
         pos_fp.write("ref_id\tmodified_positions\n")
 
+        # Options of simulate_ref_mod_context shared by all the references
+        sim_kwargs = OrderedDict(
+            nreads = nreads_per_ref,
+            intensity_mod = intensity_mod,
+            dwell_mod = dwell_mod,
+            mod_reads_freq = mod_reads_freq,
+            mod_bases_freq = mod_bases_freq,
+            mod_bases_type = mod_bases_type,
+            mod_extend_context = mod_extend_context,
+            min_mod_dist = min_mod_dist,
+            pos_rand_seed = pos_rand_seed,
+            not_bound = not_bound)
+
+        # Each reference gets its own random stream derived from data_rand_seed and its rank in ref_list,
+        # which does not depend on the other references or on the process simulating it
+        data_seed_seq = np.random.SeedSequence(data_rand_seed)
+        logger.debug("Data random seed entropy: {}".format(data_seed_seq.entropy))
+        task_iter = _iter_ref_tasks(fasta_fp, ref_list, model_fn, sim_kwargs, data_seed_seq, plot, write_cache)
+
+        # Simulate the references in parallel if required. The results are written in the references order
+        if nthreads > 1:
+            executor = ProcessPoolExecutor(max_workers=nthreads)
+            result_iter = imap_bounded(executor, _simulate_ref_task, task_iter, max_pending=nthreads*4)
+        else:
+            executor = None
+            result_iter = (_simulate_ref_task(*task) for task in task_iter)
+
         byte_offset = 0
-        # Simulate reference per reference
-        for ref_num, ref_id in enumerate(tqdm((ref_list), unit=" References", disable=log_level in ("warning", "debug"))):
-            logger.debug("Processing reference {}".format(ref_id))
-            try:
-                ref_seq = str(fasta_fp[ref_id])
-
-                # Simulate data corresponding to the reference
-                intensity_array, dwell_array, mod_pos_list, nreads_mod = simulate_ref_mod_context(
-                    ref_seq = ref_seq,
-                    model_df = model_df,
-                    nreads = nreads_per_ref,
-                    intensity_mod = intensity_mod,
-                    dwell_mod = dwell_mod,
-                    mod_reads_freq = mod_reads_freq,
-                    mod_bases_freq = mod_bases_freq,
-                    mod_bases_type = mod_bases_type,
-                    mod_extend_context = mod_extend_context,
-                    min_mod_dist = min_mod_dist,
-                    pos_rand_seed=pos_rand_seed,
-                    data_rand_seed=data_rand_seed,
-                    not_bound=not_bound)
+        row_start = 0
+        try:
+            for result in tqdm(result_iter, total=len(ref_list), unit=" References", disable=log_level in ("warning", "debug")):
+                if not result:
+                    continue
+                ref_id, data_buf, read_list, mod_pos_list, plot_data, cache_records = result
 
                 # Plot traces if required
                 if plot:
-                    plot_trace(ref_id, intensity_array, dwell_array, mod_pos_list, nreads_mod)
+                    plot_trace(ref_id, *plot_data)
 
                 # Write options used in log file
-                pos_fp.write("{}\t{}\n".format(ref_id, array_join(";", mod_pos_list)))
-
-                # Write output in NanopolishComp like files
-                for read_num in range(nreads_per_ref):
-                    read_str = "#{}_{}\t{}\n".format(ref_num, read_num, ref_id)
-                    read_str += "ref_pos\tref_kmer\tdwell_time\tmedian\n"
-                    for ref_pos in range(len(ref_seq)-4):
-                        read_str += "{}\t{}\t{}\t{}\n".format(
-                            ref_pos,
-                            ref_seq[ref_pos:ref_pos+5],
-                            dwell_array [ref_pos, read_num],
-                            intensity_array [ref_pos, read_num])
-
-                    data_fp.write(read_str)
-                    idx_fp.write("{}\t{}_{}\t{}\t{}\n".format(ref_id, ref_num, read_num, byte_offset, len(read_str)-1))
-                    byte_offset += len(read_str)
-
-            except KeyError:
-                logger.debug("Reference {} not found in reference fasta file".format(ref_id))
+                pos_fp.write("{}\t{}\n".format(ref_id, ";".join(map(str, mod_pos_list))))
+
+                # Write output in NanopolishComp like files. All the reads of the reference are written at once
+                data_fp.write(data_buf)
+                idx_fp.write("".join(["{}\t{}\t{}\t{}\n".format(ref_id, read_id, byte_offset+read_offset, read_len) for read_id, read_offset, read_len in read_list]))
+
+                # Write the records of all the reads of the reference in the binary cache and index them by read byte offset
+                if write_cache:
+                    cache_records.tofile(cache_fp)
+                    n_rows = len(cache_records)//max(len(read_list), 1)
+                    for read_num, (read_id, read_offset, read_len) in enumerate(read_list):
+                        cache_idx_list.append((byte_offset+read_offset, row_start+read_num*n_rows, n_rows, False))
+                    row_start += len(cache_records)
+                byte_offset += len(data_buf)
+        finally:
+            result_iter.close()
+            if executor:
+                executor.shutdown()
+
+    # Write the cache index once the data file is closed, and update the records file time as SampComp ignores caches older than the data file
+    if write_cache:
+        os.utime(data_fn+".cache")
+        np.save(data_fn+".cache.idx.npy", np.array(cache_idx_list, dtype=EVENTALIGN_CACHE_IDX_DTYPE))
 
 def plot_trace(ref_id, intensity_array, dwell_array, mod_pos_list, nreads_mod):
     """"""
+    # Private import as matplotlib is only needed if plotting
+    import matplotlib.pyplot as pl
+    from matplotlib.collections import LineCollection
+
+    # Modified reads in red and others in black
+    colors = np.where(np.arange(len(intensity_array)) < nreads_mod, "red", "black")
+    ref_pos = np.arange(intensity_array.shape[1])
+
     with pl.style.context("ggplot"):
         fig, axes = pl.subplots(2, 1, figsize=(30,10))
 
-        # Plot intensity data
-        for i, line in enumerate(intensity_array.T):
-            axes[0].plot(line, alpha=(1/len(intensity_array.T))*2, color="red" if i<nreads_mod else "black")
-        axes[0].set_title("Median intensity")
-        axes[0].set_xlim(0,len(intensity_array))
-
-        # Plot dwell data
-        for i, line in enumerate(dwell_array.T):
-            axes[1].plot(line, alpha=(1/len(dwell_array.T))*2, color="red" if i<nreads_mod else "black")
-        axes[1].set_title("Dwell time")
-        axes[1].set_xlim(0,len(dwell_array))
+        # Plot the traces of all the reads as a single collection per signal
+        for ax, data_array, title in ((axes[0], intensity_array, "Median intensity"), (axes[1], dwell_array, "Dwell time")):
+            segments = np.stack((np.broadcast_to(ref_pos, data_array.shape), data_array), axis=-1)
+            ax.add_collection(LineCollection(segments, colors=colors, alpha=(1/len(data_array))*2))
+            ax.autoscale_view()
+            ax.set_title(title)
+            ax.set_xlim(0,data_array.shape[1])
 
         # Add lines where the signal is modified
         for x in mod_pos_list:
@@ -221,9 +264,78 @@ def plot_trace(ref_id, intensity_array, dwell_array, mod_pos_list, nreads_mod):
         fig.suptitle(ref_id, y=1.02, fontsize=18)
         fig.tight_layout()
 
+def _iter_ref_tasks(fasta_fp, ref_list, model_fn, sim_kwargs, data_seed_seq, plot, write_cache):
+    """Yield the arguments of _simulate_ref_task for all the references of ref_list found in the fasta file"""
+    for ref_num, ref_id in enumerate(ref_list):
+        logger.debug("Processing reference {}".format(ref_id))
+        try:
+            ref_seq = fasta_fp[ref_id][:]
+        except KeyError:
+            logger.debug("Reference {} not found in reference fasta file".format(ref_id))
+            continue
+        ref_seed_seq = np.random.SeedSequence(data_seed_seq.entropy, spawn_key=(ref_num,))
+        yield (ref_num, ref_id, ref_seq, model_fn, sim_kwargs, ref_seed_seq, plot, write_cache)
+
+def _simulate_ref_task(ref_num, ref_id, ref_seq, model_fn, sim_kwargs, data_rand_seed=None, return_arrays=False, return_cache=False):
+    """
+    Pool task simulating the reads of a reference and formatting them as a NanopolishComp like data chunk.
+    Return the reference id, the chunk bytes, the list of (read_id, offset in chunk, read length) of the reads,
+    the modified positions, the data needed by plot_trace if return_arrays and the SampComp binary cache records
+    of all the reads if return_cache. Return None if some kmers of the reference are not in the model
+    """
+    try:
+        # Simulate data corresponding to the reference
+        intensity_array, dwell_array, mod_pos_list, nreads_mod = simulate_ref_mod_context(
+            ref_seq = ref_seq,
+            model_table = load_model_table(model_fn),
+            data_rand_seed = data_rand_seed,
+            **sim_kwargs)
+    except KeyError:
+        logger.debug("Reference {} contains kmers not found in the model".format(ref_id))
+        return None
+
+    # Convert all the values to their shortest str representation at once
+    dwell_str_list = dwell_array.astype(str).tolist()
+    intensity_str_list = intensity_array.astype(str).tolist()
+
+    # Template of the kmer lines fields of a read. The position and kmer columns are the same for all the reads,
+    # only the dwell time and intensity fields are replaced for each read
+    n_kmers = len(ref_seq)-4
+    field_list = [None]*(5*n_kmers)
+    field_list[0::5] = ["{}\t{}\t".format(ref_pos, ref_seq[ref_pos:ref_pos+5]) for ref_pos in range(n_kmers)]
+    field_list[2::5] = ["\t"]*n_kmers
+    field_list[4::5] = ["\n"]*n_kmers
+
+    data_buf = bytearray()
+    read_list = []
+    for read_num in range(len(intensity_array)):
+        field_list[1::5] = dwell_str_list[read_num]
+        field_list[3::5] = intensity_str_list[read_num]
+        read_bytes = "#{}_{}\t{}\nref_pos\tref_kmer\tdwell_time\tmedian\n{}".format(ref_num, read_num, ref_id, "".join(field_list)).encode()
+
+        read_list.append(("{}_{}".format(ref_num, read_num), len(data_buf), len(read_bytes)-1))
+        data_buf += read_bytes
+
+    plot_data = (intensity_array, dwell_array, mod_pos_list, nreads_mod) if return_arrays else None
+    cache_records = make_cache_records(ref_seq, intensity_array, dwell_array) if return_cache else None
+    return (ref_id, bytes(data_buf), read_list, mod_pos_list, plot_data, cache_records)
+
+def make_cache_records(ref_seq, intensity_array, dwell_array):
+    """
+    Convert the (reads, positions) arrays of a reference to the records of the SampComp eventalign binary cache,
+    read after read. The kmers events stats fields are left empty as they are not simulated
+    """
+    nreads, n_kmers = intensity_array.shape
+    records = np.zeros(nreads*n_kmers, dtype=EVENTALIGN_CACHE_DTYPE)
+    records["ref_pos"] = np.tile(np.arange(n_kmers), nreads)
+    records["ref_kmer"] = np.tile(np.array([ref_seq[i:i+5] for i in range(n_kmers)], dtype="S5"), nreads)
+    records["median"] = intensity_array.ravel()
+    records["dwell_time"] = dwell_array.ravel()
+    return records
+
 def simulate_ref_mod_context(
     ref_seq,
-    model_df,
+    model_table,
     nreads=100,
     intensity_mod=0,
     dwell_mod=0,
@@ -235,83 +347,133 @@ def simulate_ref_mod_context(
     not_bound=False,
     pos_rand_seed=42,
     data_rand_seed=None):
-    """"""
+    """
+    Simulate the (reads, positions) intensity and dwell time arrays of a reference sequence and modify the first reads at
+    randomly picked positions if required. All the values are drawn from a single numpy Generator made from data_rand_seed,
+    which can be anything accepted by np.random.default_rng. The non modified values are drawn first, so simulations with
+    the same data_rand_seed share them whatever the modification options
+    """
 
-    # Create empty arrays to store reads intensity and dwell
     n_kmers = len(ref_seq)-4
-    intensity_array = np.empty(shape=(n_kmers, nreads), dtype=np.float)
-    dwell_array = np.empty(shape=(n_kmers, nreads), dtype=np.float)
     mod_pos_list = []
     nreads_mod = 0
-
-    # Fill in arrays with non modified data per position
-    for pos in range(n_kmers):
-        kmer_seq =  ref_seq[pos:pos+5]
-        kmer_model = model_df.loc[kmer_seq]
-
-        # Sample intensity
-        intensity_array[pos] = get_valid_distr_data(
-            loc = kmer_model["model_intensity_loc"],
-            scale = kmer_model["model_intensity_scale"],
-            min = None if not_bound else kmer_model["raw_intensity_min"],
-            max = None if not_bound else kmer_model["raw_intensity_max"],
+    random_state = np.random.default_rng(data_rand_seed)
+
+    # Get the model parameters of all the kmers of the reference at once
+    kmer_idx = encode_kmers(ref_seq)
+    if (kmer_idx < 0).any():
+        raise KeyError("Some kmers of the reference sequence are not in the model")
+    kmer_params = model_table[kmer_idx]
+    if np.isnan(kmer_params["model_intensity_loc"]).any():
+        raise KeyError("Some kmers of the reference sequence are not in the model")
+
+    # Fill in the (reads, positions) float32 arrays with non modified data for all the positions at once
+    intensity_array = get_valid_distr_data(
+        loc = kmer_params["model_intensity_loc"],
+        scale = kmer_params["model_intensity_scale"],
+        min = None if not_bound else kmer_params["raw_intensity_min"],
+        max = None if not_bound else kmer_params["raw_intensity_max"],
+        sp_distrib = sp_logistic,
+        size = (nreads, n_kmers),
+        random_state = random_state).astype(np.float32)
+
+    dwell_array = get_valid_distr_data(
+        loc = kmer_params["model_dwell_loc"],
+        scale = kmer_params["model_dwell_scale"],
+        min = None if not_bound else kmer_params["raw_dwell_min"],
+        max = None if not_bound else kmer_params["raw_dwell_max"],
+        sp_distrib = sp_wald,
+        size = (nreads, n_kmers),
+        random_state = random_state).astype(np.float32)
+
+    # Control simulations stop here without setting up any modification
+    if not (mod_reads_freq and mod_bases_freq):
+        return (intensity_array, dwell_array, mod_pos_list, nreads_mod)
+
+    # Edit the values for randomly picked positions + adjacent positions if a context was given
+    # Define number of reads to modify and number not to modify
+    nreads_mod = int(np.rint(nreads*mod_reads_freq))
+    # Define positions to modify base on mod_base_freq and mod_base_type
+    mod_pos_list = find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq, min_mod_dist, pos_rand_seed)
+    # if the modification context has to be extended
+    intensity_mod_array, dwell_mod_array = make_mod_arrays(intensity_mod, dwell_mod, mod_extend_context)
+
+    # Gather the modified positions extended to their context, dropping the ones out of the reference, and the
+    # index of the corresponding modifier. All the values to modify are then sampled at once per signal
+    ext_offsets = np.arange(-mod_extend_context, mod_extend_context+1)
+    ext_positions = mod_pos_list[:,None]+ext_offsets
+    ext_mod_idx = np.broadcast_to(ext_offsets+mod_extend_context, ext_positions.shape)
+    valid = (ext_positions >= 0) & (ext_positions < n_kmers)
+    ext_positions = ext_positions[valid]
+    ext_mod_idx = ext_mod_idx[valid]
+    ext_params = kmer_params[ext_positions]
+
+    if intensity_mod:
+        intensity_array[0:nreads_mod, ext_positions] = get_valid_distr_data(
+            loc = ext_params["model_intensity_loc"],
+            scale = ext_params["model_intensity_scale"],
+            min = None if not_bound else ext_params["raw_intensity_min"],
+            max = None if not_bound else ext_params["raw_intensity_max"],
+            mod = ext_params["model_intensity_std"]*intensity_mod_array[ext_mod_idx],
             sp_distrib = sp_logistic,
-            size=nreads,
-            data_rand_seed=data_rand_seed)
-
-        # Sample dwell
-        dwell_array[pos] = get_valid_distr_data(
-            loc = kmer_model["model_dwell_loc"],
-            scale = kmer_model["model_dwell_scale"],
-            min = None if not_bound else kmer_model["raw_dwell_min"],
-            max = None if not_bound else kmer_model["raw_dwell_max"],
+            size = (nreads_mod, len(ext_positions)),
+            random_state = random_state)
+
+    if dwell_mod:
+        dwell_array[0:nreads_mod, ext_positions] = get_valid_distr_data(
+            loc = ext_params["model_dwell_loc"],
+            scale = ext_params["model_dwell_scale"],
+            min = None if not_bound else ext_params["raw_dwell_min"],
+            max = None if not_bound else ext_params["raw_dwell_max"],
+            mod = ext_params["model_dwell_std"]*dwell_mod_array[ext_mod_idx],
             sp_distrib = sp_wald,
-            size=nreads,
-            data_rand_seed=data_rand_seed)
-
-    # If modifications are required, edit the values for randomly picked positions + adjacent positions if a context was given
-    if mod_reads_freq and mod_bases_freq:
-        # Define number of reads to modify and number not to modify
-        nreads_mod = int(np.rint(nreads*mod_reads_freq))
-        # Define positions to modify base on mod_base_freq and mod_base_type
-        mod_pos_list = find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq, min_mod_dist, pos_rand_seed)
-        # if the modification context has to be extended
-        mod_dict = make_mod_dict(intensity_mod, dwell_mod, mod_extend_context)
-
-
-        for pos in mod_pos_list:
-            for i in range(-mod_extend_context, mod_extend_context+1):
-                pos_extend = pos+i
-                if 0 <= pos_extend < n_kmers:
-                    kmer_seq = ref_seq[pos_extend:pos_extend+5]
-                    kmer_model = model_df.loc[kmer_seq]
-
-                    if intensity_mod:
-                        intensity_array[pos_extend][0:nreads_mod] = get_valid_distr_data(
-                            loc = kmer_model["model_intensity_loc"],
-                            scale = kmer_model["model_intensity_scale"],
-                            min = None if not_bound else kmer_model["raw_intensity_min"],
-                            max = None if not_bound else kmer_model["raw_intensity_max"],
-                            mod = kmer_model["model_intensity_std"]*mod_dict["intensity"][i],
-                            sp_distrib = sp_logistic,
-                            size = nreads_mod,
-                            data_rand_seed = data_rand_seed)
-
-                    if dwell_mod:
-                        dwell_array[pos_extend][0:nreads_mod] = get_valid_distr_data(
-                            loc = kmer_model["model_dwell_loc"],
-                            scale = kmer_model["model_dwell_scale"],
-                            min = None if not_bound else kmer_model["raw_dwell_min"],
-                            max = None if not_bound else kmer_model["raw_dwell_max"],
-                            mod = kmer_model["model_dwell_std"]*mod_dict["dwell"][i],
-                            sp_distrib = sp_wald,
-                            size = nreads_mod,
-                            data_rand_seed = data_rand_seed)
+            size = (nreads_mod, len(ext_positions)),
+            random_state = random_state)
 
     return (intensity_array, dwell_array, mod_pos_list, nreads_mod)
 
+def encode_kmers(seq):
+    """
+    Return the 10 bits integer index of all the kmers of a sequence in a model table made with make_model_table.
+    Kmers containing other bases than ACGT get a -1 index
+    """
+    base_codes = base_code_array[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+    n_kmers = max(len(base_codes)-4, 0)
+    kmer_idx = np.zeros(n_kmers, dtype=np.int64)
+    invalid = np.zeros(n_kmers, dtype=bool)
+    for i in range(5):
+        kmer_idx = (kmer_idx << 2) | base_codes[i:i+n_kmers]
+        invalid |= base_codes[i:i+n_kmers] < 0
+    kmer_idx[invalid] = -1
+    return kmer_idx
+
+def make_model_table(model_df):
+    """
+    Convert a kmer model DataFrame to a dense structured array of the 4^5 possible kmers indexed by encode_kmers.
+    Kmers missing from the model are filled with NaN
+    """
+    model_table = np.full(4**5, np.nan, dtype=[(col, np.float64) for col in model_df.columns])
+    kmer_idx = encode_kmers("".join(model_df.index))[::5]
+    for col in model_df.columns:
+        model_table[col][kmer_idx] = model_df[col].values
+    return model_table
+
+@lru_cache(maxsize=4)
+def load_model_table(model_fn):
+    """
+    Parse a kmer model file and convert it to a dense table with make_model_table.
+    The table is cached and shared between calls, so it is made read only
+    """
+    model_df = pd.read_csv(model_fn, sep="\t", comment="#", index_col=0)
+    model_table = make_model_table(model_df)
+    model_table.flags.writeable = False
+    return model_table
+
 def find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq, min_mod_dist, pos_rand_seed=42):
-    """"""
+    """
+    Randomly pick positions of mod_bases_type bases to modify, at least min_mod_dist apart from each other.
+    The candidate positions are visited in a random order and kept if they are far enough from the positions already picked
+    """
     pos_list = []
     for i in range(len(ref_seq)-4):
         if ref_seq[i] == mod_bases_type:
@@ -319,45 +481,50 @@ def find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq, min_mod_dist, p
     n_samples = int(np.rint(len(pos_list)*mod_bases_freq))
     logger.debug("\tTry to find {} kmers to modify".format(n_samples))
 
-    i = 0
-    while True:
-        np.random.seed(pos_rand_seed*i)
-        a = np.random.choice(pos_list, n_samples, replace=False)
-        a.sort()
-        if np.ediff1d(a).min() >= min_mod_dist :
-            logger.debug("\tFound valid combination for {} kmers".format(n_samples))
-            logger.debug("\tmodified positions: {}".format(a))
+    random_state = np.random.default_rng(pos_rand_seed)
+    a = []
+    for pos in random_state.permutation(pos_list).tolist():
+        if len(a) == n_samples:
             break
-        if i == 1000:
-            i = 0
-            n_samples -= 1
-        i+=1
-    return a
+        # Check the distance with the closest picked positions on both sides
+        j = bisect.bisect_left(a, pos)
+        if (j == 0 or pos-a[j-1] >= min_mod_dist) and (j == len(a) or a[j]-pos >= min_mod_dist):
+            a.insert(j, pos)
 
-def get_valid_distr_data(loc, scale, size, sp_distrib, mod=None, min=None, max=None, max_tries=10000, data_rand_seed=None):
-    """"""
+    logger.debug("\tFound valid combination for {} kmers".format(len(a)))
+    logger.debug("\tmodified positions: {}".format(a))
+    return np.array(a, dtype=np.int64)
+
+def get_valid_distr_data(loc, scale, size, sp_distrib, mod=None, min=None, max=None, max_tries=10000, random_state=None):
+    """
+    Sample values from sp_distrib within the ]min, max[ bounds. loc, scale, mod, min and max can be arrays
+    broadcastable to size to sample the values from different distributions at once.
+    Only the values out of bounds are resampled
+    """
 
     # If a mofidier is given modify the loc, min and max value accordingly
-    if mod:
-        loc+=mod
-        if min:
-            min+=mod
-        if max:
-            max+=mod
+    if mod is not None:
+        loc = loc+mod
+        if min is not None:
+            min = min+mod
+        if max is not None:
+            max = max+mod
 
     # Define lower and upper bound if not given
-    if not min:
+    if min is None:
         min=0
-    if not max:
-        max=np.finfo(np.float64).max
+    if max is None:
+        max=float64_max
+
+    # Broadcast all the parameters to the output shape
+    loc, scale, min, max = [np.broadcast_to(v, size) for v in (loc, scale, min, max)]
 
     # Try to sample the required number of data point
+    data = sp_distrib.rvs(loc=loc, scale=scale, size=size, random_state=random_state)
     i = 0
     while True:
-        iter_rand_seed = None if data_rand_seed is None else data_rand_seed + i
-        np.random.seed(iter_rand_seed)
-        data = sp_distrib.rvs(loc=loc, scale=scale, size=size, random_state=iter_rand_seed)
-        if data.min() > min and data.max() < max:
+        invalid = (data <= min) | (data >= max)
+        if not invalid.any():
             return data
 
         # Safety trigger
@@ -366,25 +533,22 @@ def get_valid_distr_data(loc, scale, size, sp_distrib, mod=None, min=None, max=N
         if i > max_tries:
             logger.debug("\tCould not find valid values with min max bounds. Fall back to safe bounds")
             logger.debug("\tYou should consider using the `not_bound` option")
-            min=0
-            max=np.finfo(np.float64).max
+            min=np.zeros(size)
+            max=np.full(size, float64_max)
         # If too many tries raise an exception
         if i > max_tries*2:
             raise NanocomporeError("Could not find valid data after {} tries".format(i))
 
-def make_mod_dict(intensity_mod, dwell_mod, mod_extend_context):
-    """Compute a harmonic series per values depending on the context length"""
-    pos_list = list(range(-mod_extend_context, mod_extend_context+1))
-    d = OrderedDict()
-    d["intensity"] = {i: intensity_mod*(1/(abs(i)+1)) for i in pos_list}
-    d["dwell"] = {i: dwell_mod*(1/(abs(i)+1)) for i in pos_list}
-    return d
-
-def array_join(sep, array):
-    s = ""
-    for i in array:
-        s+="{}{}".format(i,sep)
-    return s[:-len(sep)]
+        # Resample the invalid values only
+        data[invalid] = sp_distrib.rvs(loc=loc[invalid], scale=scale[invalid], size=np.count_nonzero(invalid), random_state=random_state)
+
+def make_mod_arrays(intensity_mod, dwell_mod, mod_extend_context):
+    """
+    Compute a harmonic series per values depending on the context length.
+    Return the intensity and dwell arrays of modifiers indexed by the offset to the modified position + mod_extend_context
+    """
+    weights = 1/(np.abs(np.arange(-mod_extend_context, mod_extend_context+1))+1)
+    return intensity_mod*weights, dwell_mod*weights
 
 def parse_mod_pos_file(path):
     """ Parses a pos file generated by SimReads()
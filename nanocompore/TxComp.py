@@ -187,15 +187,16 @@ def gmm_test(data, random_state, anova=True, logit=False, verbose=True, allow_wa
         raise NanocomporeError("gmm_test only supports two conditions")
 
     # Merge the intensities and dwell times of all samples in a single array
-    global_intensity = np.concatenate(([v['intensity'] for v in data[condition_labels[0]].values()]+[v['intensity'] for v in data[condition_labels[1]].values()]), axis=None)
-    global_dwell = np.concatenate(([v['dwell'] for v in data[condition_labels[0]].values()]+[v['dwell'] for v in data[condition_labels[1]].values()]), axis=None)
+    sample_data_list = list(data[condition_labels[0]].values()) + list(data[condition_labels[1]].values())
+    global_intensity = np.concatenate([v['intensity'] for v in sample_data_list], axis=None)
+    global_dwell = np.concatenate([v['dwell'] for v in sample_data_list], axis=None)
     global_dwell = np.log10(global_dwell)
 
     # Scale the intensity and dwell time arrays
-    X = StandardScaler().fit_transform([(i, d) for i,d in zip(global_intensity, global_dwell)])
+    X = StandardScaler().fit_transform(np.column_stack((global_intensity, global_dwell)))
 
     # Generate an array of sample labels
-    Y = [ k for k,v in data[condition_labels[0]].items() for _ in v['intensity'] ] + [ k for k,v in data[condition_labels[1]].items() for _ in v['intensity'] ]
+    Y = np.repeat(sample_labels, [len(v['intensity']) for v in sample_data_list])
 
     gmm_fit = fit_best_gmm(X, max_components=2, cv_types=['full'], random_state=random_state)
     gmm_mod, gmm_type, gmm_ncomponents = gmm_fit
@@ -207,7 +208,7 @@ def gmm_test(data, random_state, anova=True, logit=False, verbose=True, allow_wa
         counters = dict()
         # Count how many reads in each cluster for each sample
         for lab in sample_labels:
-            counters[lab] = Counter(y_pred[[i==lab for i in Y]])
+            counters[lab] = Counter(y_pred[Y==lab])
         cluster_counts = count_reads_in_cluster(counters)
         if anova:
             aov_results = gmm_anova_test(counters, sample_condition_labels, condition_labels, gmm_ncomponents, allow_warnings)
@@ -215,7 +216,7 @@ def gmm_test(data, random_state, anova=True, logit=False, verbose=True, allow_wa
             aov_results=None
 
         if logit:
-            logit_results = gmm_logit_test(Y, y_pred, sample_condition_labels, condition_labels)
+            logit_results = gmm_logit_test(Y.tolist(), y_pred, sample_condition_labels, condition_labels)
         else:
             logit_results=None
 
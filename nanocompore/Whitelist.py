@@ -9,6 +9,7 @@ import random
 
 # Third party
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from pyfaidx import Fasta
 
@@ -164,49 +165,58 @@ class Whitelist(object):
         for cond_lab, sample_dict in eventalign_fn_dict.items():
             for sample_lab, fn in sample_dict.items():
                 idx_fn = fn+".idx"
-                with open(idx_fn) as fp:
-
-                    # Get column names from header
-                    col_names = fp.readline().rstrip().split()
-                    c = Counter()
-                    for line in fp:
-                        try:
-                            # Transform line to dict and cast str numbers to actual numbers
-                            read = numeric_cast_dict(keys=col_names, values=line.rstrip().split("\t"))
-
-                            # Filter out ref_id if a select_ref_id list or exclude_ref_id list was provided
-                            if select_ref_id and not read["ref_id"] in select_ref_id:
-                                raise NanocomporeError("Ref_id not in select list")
-                            elif exclude_ref_id and read["ref_id"] in exclude_ref_id:
-                                raise NanocomporeError("Ref_id in exclude list")
-
-                            # Filter out reads with high number of invalid kmers if information available
-                            if self.__filter_invalid_kmers:
-                                if max_invalid_kmers_freq:
-                                    if(read["NNNNN_kmers"]+read["mismatch_kmers"]+read["missing_kmers"])/read["kmers"] > max_invalid_kmers_freq:
-                                        raise NanocomporeError("High invalid kmers reads")
-                                else:
-                                    if max_NNNNN_freq and read["NNNNN_kmers"]/read["kmers"] > max_NNNNN_freq:
-                                        raise NanocomporeError("High NNNNN kmers reads")
-                                    elif max_mismatching_freq and read["mismatch_kmers"]/read["kmers"] > max_mismatching_freq:
-                                        raise NanocomporeError("High mismatch_kmers reads")
-                                    elif max_missing_freq and read["missing_kmers"]/read["kmers"] > max_missing_freq:
-                                        raise NanocomporeError("High missing_kmers reads")
-
-                            # Create dict arborescence and save valid reads
-                            if not read["ref_id"] in ref_reads:
-                                ref_reads[read["ref_id"]] = OrderedDict()
-                            if not cond_lab in ref_reads[read["ref_id"]]:
-                                ref_reads[read["ref_id"]][cond_lab] = OrderedDict()
-                            if not sample_lab in ref_reads[read["ref_id"]][cond_lab]:
-                                ref_reads[read["ref_id"]][cond_lab][sample_lab] = []
-
-                            # Fill in list of reads
-                            ref_reads[read["ref_id"]][cond_lab][sample_lab].append(read)
-                            c ["valid reads"] += 1
-
-                        except NanocomporeError as E:
-                            c [str(E)] += 1
+
+                # Parse the whole index file at once and cast str numbers to actual numbers column wise
+                idx_df = pd.read_csv(idx_fn, sep="\t", dtype=str, na_filter=False)
+                for col in idx_df.columns:
+                    idx_df[col] = numeric_cast_series(idx_df[col])
+
+                # Define the read filters in order of priority
+                filter_list = []
+                # Filter out ref_id if a select_ref_id list or exclude_ref_id list was provided
+                if select_ref_id:
+                    filter_list.append(("Ref_id not in select list", ~idx_df["ref_id"].isin(select_ref_id)))
+                if exclude_ref_id:
+                    filter_list.append(("Ref_id in exclude list", idx_df["ref_id"].isin(exclude_ref_id)))
+                # Filter out reads with high number of invalid kmers if information available
+                if self.__filter_invalid_kmers:
+                    if max_invalid_kmers_freq:
+                        invalid_kmers = idx_df["NNNNN_kmers"]+idx_df["mismatch_kmers"]+idx_df["missing_kmers"]
+                        filter_list.append(("High invalid kmers reads", invalid_kmers/idx_df["kmers"] > max_invalid_kmers_freq))
+                    else:
+                        if max_NNNNN_freq:
+                            filter_list.append(("High NNNNN kmers reads", idx_df["NNNNN_kmers"]/idx_df["kmers"] > max_NNNNN_freq))
+                        if max_mismatching_freq:
+                            filter_list.append(("High mismatch_kmers reads", idx_df["mismatch_kmers"]/idx_df["kmers"] > max_mismatching_freq))
+                        if max_missing_freq:
+                            filter_list.append(("High missing_kmers reads", idx_df["missing_kmers"]/idx_df["kmers"] > max_missing_freq))
+
+                # Count reads by first failed filter
+                c = Counter()
+                valid = np.ones(len(idx_df), dtype=bool)
+                for lab, filtered in filter_list:
+                    filtered = filtered.values & valid
+                    if filtered.any():
+                        c[lab] += int(filtered.sum())
+                    valid &= ~filtered
+                if valid.any():
+                    c["valid reads"] += int(valid.sum())
+
+                # Transform valid lines to dict. Columns are converted to lists of python values at once
+                idx_df = idx_df[valid]
+                col_names = list(idx_df.columns)
+                for values in zip(*[idx_df[col].tolist() for col in col_names]):
+                    read = dict(zip(col_names, values))
+                    # Create dict arborescence and save valid reads
+                    if not read["ref_id"] in ref_reads:
+                        ref_reads[read["ref_id"]] = OrderedDict()
+                    if not cond_lab in ref_reads[read["ref_id"]]:
+                        ref_reads[read["ref_id"]][cond_lab] = OrderedDict()
+                    if not sample_lab in ref_reads[read["ref_id"]][cond_lab]:
+                        ref_reads[read["ref_id"]][cond_lab][sample_lab] = []
+
+                    # Fill in list of reads
+                    ref_reads[read["ref_id"]][cond_lab][sample_lab].append(read)
 
                 logger.debug("\tCondition:{} Sample:{} {}".format(cond_lab, sample_lab, counter_to_str(c)))
         # Fill in missing condition/sample slots in case
@@ -127,6 +127,10 @@ def main(args=None):
         help="Define a seed for randon position picking to get a deterministic behaviour (default: %(default)s)")
     parser_sr_common.add_argument("--not_bound", action='store_true', default=False,
         help="Do not bind the values generated by the distributions to the observed min and max observed values from the model file (default: %(default)s)")
+    parser_sr_common.add_argument("--nthreads", "-t", type=int, default=1,
+        help="Number of processes used to simulate the references in parallel (default: %(default)s)")
+    parser_sr_common.add_argument("--write_cache", action='store_true', default=False,
+        help="Also write the simulated data in the binary cache format used by sampcomp (default: %(default)s)")
     parser_sr_common.add_argument("--log_level", type=str, default="info", choices=["warning", "info", "debug"],
         help="Set the log level (default: %(default)s)")
 
@@ -195,6 +199,8 @@ def simreads_main(args):
         min_mod_dist = args.min_mod_dist,
         pos_rand_seed = args.pos_rand_seed,
         not_bound = args.not_bound,
+        nthreads = args.nthreads,
+        write_cache = args.write_cache,
         log_level = args.log_level)
 
 def plot(args):
@@ -6,6 +6,19 @@ import sys
 import os
 from collections import *
 import inspect
+import pickle
+import struct
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Optional third party imports
+try:
+    import numba
+except ImportError:
+    numba = None
 
 #~~~~~~~~~~~~~~CUSTOM EXCEPTION CLASS~~~~~~~~~~~~~~#
 class NanocomporeError (Exception):
@@ -16,6 +29,23 @@ class NanocomporeWarning (Warning):
     """ Basic Warning class for nanocompore module """
     pass
 
+#~~~~~~~~~~~~~~EVENTALIGN BINARY CACHE~~~~~~~~~~~~~~#
+# Record type of the eventalign binary cache written by SampComp.precompute_cache and SimReads
+EVENTALIGN_CACHE_DTYPE = np.dtype([
+    ("ref_pos", np.int64),
+    ("ref_kmer", "S5"),
+    ("median", np.float32),
+    ("dwell_time", np.float32),
+    ("NNNNN_dwell_time", np.float32),
+    ("mismatch_dwell_time", np.float32)])
+
+# Per read index of the eventalign binary cache
+EVENTALIGN_CACHE_IDX_DTYPE = np.dtype([
+    ("byte_offset", np.int64),
+    ("row_start", np.int64),
+    ("n_rows", np.int64),
+    ("kmers_stats", np.bool_)])
+
 #~~~~~~~~~~~~~~FUNCTIONS~~~~~~~~~~~~~~#
 def mkdir (fn, exist_ok=False):
     """ Create directory recursivelly. Raise IO error if path exist or if error at creation """
@@ -42,6 +72,15 @@ def numeric_cast_dict (keys, values):
         d[k] = numeric_cast(v)
     return d
 
+def numeric_cast_series (s):
+    """ Cast a pandas Series of str values to integer or float like numeric_cast. Integer Series are cast in bulk, the others value by value """
+    try:
+        return s.astype("int64")
+    except (ValueError, OverflowError):
+        pass
+    # The object dtype keeps the python int and float values of mixed Series as numeric_cast returns them
+    return pd.Series([numeric_cast(v) for v in s], index=s.index, dtype=object)
+
 def numeric_cast (v):
     if type(v)== str:
         try:
@@ -53,6 +92,77 @@ def numeric_cast (v):
                 pass
     return v
 
+def write_db_index (fp, index):
+    """
+    Terminate a result database file with its index.
+    The database is a stream of pickled objects followed by a pickled index dict and the 8 bytes offset of the index
+    """
+    index_offset = fp.tell()
+    pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    fp.write(struct.pack("<Q", index_offset))
+
+def read_db_index (fp):
+    """ Read the index dict written at the end of a result database file with write_db_index """
+    fp.seek(-8, os.SEEK_END)
+    index_offset = struct.unpack("<Q", fp.read(8))[0]
+    fp.seek(index_offset)
+    return pickle.load(fp)
+
+def read_db_item (fp, offset):
+    """ Read a single pickled object from a result database file at the given offset """
+    fp.seek(offset)
+    return pickle.load(fp)
+
+def imap_bounded (executor, fn, iterable, max_pending, discard_fn=None):
+    """
+    Lazily submit fn(*item) for all the items of iterable to the executor and yield the results in order.
+    At most max_pending tasks are submitted ahead to bound the memory used by unconsumed results.
+    The remaining tasks are cancelled if the generator is closed early. The tasks which cannot be cancelled
+    anymore are waited for and discard_fn is called on their results, to release the resources they hold
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, *item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        _discard_futures(pending, discard_fn)
+
+def imap_unordered_bounded (executor, fn, iterable, max_pending, discard_fn=None):
+    """
+    Same as imap_bounded but yield the results as soon as the tasks complete, so that a long task does not hold
+    back the submission of the next ones
+    """
+    pending = set()
+    done = deque()
+    try:
+        for item in iterable:
+            pending.add(executor.submit(fn, *item))
+            if len(pending) >= max_pending:
+                completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done.extend(completed)
+                while done:
+                    yield done.popleft().result()
+        while pending:
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            done.extend(completed)
+            while done:
+                yield done.popleft().result()
+    finally:
+        _discard_futures(list(done)+list(pending), discard_fn)
+
+def _discard_futures (futures, discard_fn):
+    """ Cancel the futures and call discard_fn on the results of the ones which cannot be cancelled anymore """
+    for future in futures:
+        if not future.cancel() and discard_fn:
+            try:
+                discard_fn(future.result())
+            except Exception:
+                pass
+
 def counter_to_str (c):
     """ Transform a counter dict to a tabulated str """
     m = ""
@@ -129,6 +129,71 @@ def test_deterministic_behaviour(nanopolishcomp_test_files):
     db.save_report(tmp_path+"/report2.txt")
     assert hash_file(tmp_path+"/report1.txt") == hash_file(tmp_path+"/report2.txt")
 
+def test_eventalign_cache(nanopolishcomp_test_files):
+    fasta_file, fn_dict, tmp_path = nanopolishcomp_test_files
+    sampcomp_kwargs = dict(
+            eventalign_fn_dict=fn_dict,
+            outpath=tmp_path,
+            outprefix="nanocompore",
+            comparison_methods="GMM,KS,TT,MW",
+            sequence_context=2,
+            fasta_fn=fasta_file,
+            allow_warnings=False,
+            downsample_high_coverage = None,
+            nthreads=6,
+            overwrite=True)
+    db = SampComp(**sampcomp_kwargs)()
+    db.save_report(tmp_path+"/report_text.txt")
+
+    # Same analysis reading the data from the binary cache
+    SampComp.precompute_cache(fn_dict)
+    db = SampComp(**sampcomp_kwargs)()
+    db.save_report(tmp_path+"/report_cache.txt")
+    assert hash_file(tmp_path+"/report_text.txt") == hash_file(tmp_path+"/report_cache.txt")
+
+def test_simreads_cache(fasta_file, tmp_path):
+    # Simulate the same data twice, with and without writing the binary cache
+    for outprefix, write_cache in (("simulated", True), ("reference", False)):
+        SimReads (
+            fasta_fn=fasta_file,
+            outpath=str(tmp_path),
+            outprefix=outprefix,
+            intensity_mod=2,
+            mod_reads_freq=0.5,
+            data_rand_seed=42,
+            write_cache=write_cache,
+            overwrite=True)
+
+    # The cache written by SimReads must be identical to the one computed from the text file
+    SampComp.precompute_cache({'S1':{'R1':str(tmp_path/"reference.tsv")}})
+    for ext in [".cache", ".cache.idx.npy"]:
+        assert hash_file(str(tmp_path/"simulated.tsv")+ext) == hash_file(str(tmp_path/"reference.tsv")+ext)
+
+def test_simreads_parallel(tmp_path):
+    # Several references to be dispatched to the worker processes
+    fasta_file = str(tmp_path/"reference.fa")
+    random.seed(42)
+    with open(fasta_file, 'w') as f:
+        for n in range(0,5):
+            f.write('>Ref_00{}\n'.format(n))
+            f.write("".join([random.choice("ACGT") for _ in range(0,random.randint(100, 500))])+"\n")
+
+    # Simulate the same data with and without parallel processes
+    for nthreads in [1, 2]:
+        SimReads (
+            fasta_fn=fasta_file,
+            outpath=str(tmp_path),
+            outprefix="nthreads_{}".format(nthreads),
+            intensity_mod=2,
+            dwell_mod=2,
+            mod_reads_freq=0.5,
+            data_rand_seed=42,
+            nthreads=nthreads,
+            overwrite=True)
+
+    for ext in [".tsv", ".tsv.idx", "_pos.tsv"]:
+        assert hash_file(str(tmp_path/"nthreads_1")+ext) == hash_file(str(tmp_path/"nthreads_2")+ext)
+
 def hash_file(file):
     """
     Returns the sha1 checksum of a file reading
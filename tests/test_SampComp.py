@@ -0,0 +1,49 @@
+import pytest
+import numpy as np
+from nanocompore.SampComp import _accumulate_read, _accumulate_read_numpy, _accumulate_read_loop
+
+@pytest.fixture(scope="module")
+def read_list():
+    """ Random reads with gaps over a 200 positions reference. The first read starts at position 0 followed by a gap """
+    rng = np.random.default_rng(42)
+    read_list = []
+    for i in range(200):
+        start = 0 if i == 0 else rng.integers(0, 150)
+        end = rng.integers(start+1, 200)
+        pos = np.arange(start, end)
+        pos = pos[rng.random(len(pos)) > 0.2] if len(pos) > 2 else pos
+        if not len(pos):
+            pos = np.array([start])
+        # Gap right after position 0 in the first read
+        if i == 0:
+            pos = np.concatenate(([0], pos[pos > 2]))
+        n = len(pos)
+        dwell = rng.uniform(0.001, 0.1, n).astype(np.float32)
+        read_list.append((
+            pos.astype(np.int64),
+            rng.normal(100, 10, n).astype(np.float32),
+            dwell,
+            (dwell*rng.uniform(0, 0.3, n)).astype(np.float32),
+            (dwell*rng.uniform(0, 0.3, n)).astype(np.float32)))
+    return read_list
+
+def accumulate(func, read_list, kmers_stats):
+    n_pos, n_reads = 200, len(read_list)
+    intensity_arr = np.zeros((n_pos, n_reads), dtype=np.float32)
+    dwell_arr = np.zeros((n_pos, n_reads), dtype=np.float32)
+    coverage = np.zeros(n_pos, dtype=np.int32)
+    kmers_stats_arr = np.zeros((n_pos, 4), dtype=np.float64)
+    for pos, median, dwell, NNNNN_dwell, mismatch_dwell in read_list:
+        func(pos, median, dwell, NNNNN_dwell, mismatch_dwell, intensity_arr, dwell_arr, coverage, kmers_stats_arr, kmers_stats)
+    return intensity_arr, dwell_arr, coverage, kmers_stats_arr
+
+@pytest.mark.parametrize("kmers_stats", [True, False])
+@pytest.mark.parametrize("func", [_accumulate_read_loop, _accumulate_read])
+def test_accumulate_read(read_list, kmers_stats, func):
+    expected = accumulate(_accumulate_read_numpy, read_list, kmers_stats)
+    for array, expected_array in zip(accumulate(func, read_list, kmers_stats), expected):
+        np.testing.assert_array_equal(array, expected_array)
+    # The read starting at position 0 must have its gaps counted as missing
+    if kmers_stats:
+        pos = read_list[0][0]
+        assert expected[3][np.setdiff1d(np.arange(pos[-1]), pos), 0].min() >= 1
@@ -0,0 +1,24 @@
+import pytest
+import random
+import numpy as np
+from nanocompore.SimReads import find_valid_pos_list
+
+@pytest.fixture(scope="module")
+def ref_seq():
+    random.seed(42)
+    return "".join([random.choice("ACGT") for _ in range(0,2000)])
+
+@pytest.mark.parametrize("mod_bases_type", ["A", "C"])
+@pytest.mark.parametrize("min_mod_dist", [1, 6, 20])
+def test_find_valid_pos_list(ref_seq, mod_bases_type, min_mod_dist):
+    pos_array = find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq=0.25, min_mod_dist=min_mod_dist, pos_rand_seed=66)
+    pos_list = pos_array.tolist()
+    assert pos_list
+    # Sorted and unique positions
+    assert pos_list == sorted(set(pos_list))
+    # Only positions of the required base type within the kmers of the reference
+    assert all(ref_seq[pos] == mod_bases_type and pos < len(ref_seq)-4 for pos in pos_list)
+    # Positions far enough from each other
+    assert (np.diff(pos_array) >= min_mod_dist).all()
+    # Deterministic for a given seed
+    assert find_valid_pos_list(ref_seq, mod_bases_type, mod_bases_freq=0.25, min_mod_dist=min_mod_dist, pos_rand_seed=66).tolist() == pos_list
@@ -2,9 +2,11 @@ import pytest
 from nanocompore.TxComp import *
 from scipy.stats import combine_pvalues
 import numpy as np
+import pandas as pd
 from unittest import mock
 from nanocompore.SimReads import SimReads
 from nanocompore.Whitelist import Whitelist
+from nanocompore.common import numeric_cast, numeric_cast_series
 
 
 @pytest.fixture(scope="module")
@@ -49,3 +51,16 @@ def test_high_cov_filter(nanopolishcomp_test_files):
     fasta_file, fn_dict = nanopolishcomp_test_files
     whitelist = Whitelist(eventalign_fn_dict = fn_dict, fasta_fn = fasta_file, min_coverage = 101)
     assert len(whitelist.ref_reads) == 0
+
+@pytest.mark.parametrize("values", [
+    ['1', '2', '3'],
+    ['1.5', '2.0'],
+    ['1', '2.5'],
+    ['1', '2', 'X'],
+    ['ref_0001', 'ref_0002'],
+])
+def test_numeric_cast_series(values):
+    cast_list = numeric_cast_series(pd.Series(values)).tolist()
+    expected_list = [numeric_cast(v) for v in values]
+    assert cast_list == expected_list
+    assert [type(v) for v in cast_list] == [type(v) for v in expected_list]